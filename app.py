@@ -1,50 +1,41 @@
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
-import json
+from fastapi import FastAPI, Form, Response
+from collections import namedtuple
+from xml.sax.saxutils import escape as xml_escape
 import random
+import re
 import os
 
-app = Flask(__name__)
+from store import create_store
+
+app = FastAPI()
 
 # Configuration
-DATA_FILE = "players.json"
 PLAYERS_PER_TEAM = 6
 
-# Initialize data structure
-def init_data():
-    """Initialize default data structure"""
-    return {
-        "admins": [],  # List of admin phone numbers
-        "players": {},  # {phone: {name}}
-        "session": {
-            "active": False,
-            "participants": []  # List of phones who said "in"
-        }
-    }
+# TwiML replies; same markup as twilio's MessagingResponse with one message
+TWIML_TEMPLATE = '<?xml version="1.0" encoding="UTF-8"?><Response><Message>{body}</Message></Response>'
+TWIML_EMPTY = '<?xml version="1.0" encoding="UTF-8"?><Response><Message /></Response>'
 
-def load_data():
-    """Load data with error handling"""
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "r") as f:
-                return json.load(f)
-        else:
-            return init_data()
-    except Exception as e:
-        print(f"Error loading data: {e}")
-        return init_data()
+# Twilio sends WhatsApp senders as "whatsapp:+<digits>"
+WHATSAPP_PREFIX = "whatsapp:"
+NON_DIGITS_RE = re.compile(r"[^0-9]")
 
-def save_data(data):
-    """Save data with error handling"""
-    try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        print(f"Error saving data: {e}")
+# Message text
+TEAM_EMOJIS = ("🔴", "🔵", "🟢", "🟡", "🟣", "🟠", "⚫", "⚪")
+TEAM_NAMES = ("Red", "Blue", "Green", "Yellow", "Purple", "Orange", "Black", "White")
+SEPARATOR = "=" * 30
 
-def is_admin(phone, data):
-    """Check if user is admin"""
-    return phone in data.get("admins", [])
+HELP_USER = ("⚽ *FOOTBALL BOT COMMANDS*\n\n"
+             "*Everyone:*\n"
+             "• in - Join this week\n"
+             "• out - Skip this week\n\n")
+HELP_ADMIN = ("*Admin Only:*\n"
+              "• /start - Start selection\n"
+              "• /end - Create random teams\n"
+              "• /status - View status\n"
+              "• /reset - Reset session")
+
+store = create_store()
 
 def create_teams(players):
     """
@@ -59,9 +50,8 @@ def create_teams(players):
     if num_players == 0:
         return []
     
-    # Random shuffle
-    shuffled = players.copy()
-    random.shuffle(shuffled)
+    # Random shuffle (sample returns a shuffled copy in one step)
+    shuffled = random.sample(players, num_players)
     
     # Create teams of exactly 6, remainder goes to last team
     teams = []
@@ -73,241 +63,238 @@ def create_teams(players):
 
 def format_teams(teams):
     """Format teams for WhatsApp message"""
-    team_emojis = ["🔴", "🔵", "🟢", "🟡", "🟣", "🟠", "⚫", "⚪"]
-    team_names = ["Red", "Blue", "Green", "Yellow", "Purple", "Orange", "Black", "White"]
-    
-    text = "⚽ *THIS WEEK'S TEAMS* ⚽\n"
-    text += "=" * 30 + "\n\n"
+    parts = ["⚽ *THIS WEEK'S TEAMS* ⚽\n", SEPARATOR, "\n\n"]
     
     for i, team in enumerate(teams):
         if not team:  # Skip empty teams
             continue
             
-        emoji = team_emojis[i % len(team_emojis)]
-        name = team_names[i % len(team_names)]
+        emoji = TEAM_EMOJIS[i % len(TEAM_EMOJIS)]
+        name = TEAM_NAMES[i % len(TEAM_NAMES)]
         
-        text += f"{emoji} *{name} Team* ({len(team)} players)\n"
-        
-        for p in team:
-            text += f"  • {p['name']}\n"
-        text += "\n"
+        parts.append(f"{emoji} *{name} Team* ({len(team)} players)\n")
+        parts.extend(f"  • {p['name']}\n" for p in team)
+        parts.append("\n")
     
-    return text
+    return "".join(parts)
 
-@app.route("/whatsapp", methods=["POST"])
-def whatsapp_bot():
-    """Main webhook handler"""
-    msg_body = request.values.get("Body", "").strip()
-    sender = request.values.get("From", "")
-    profile_name = request.values.get("ProfileName", "Player")
+# === ADMIN COMMANDS ===
+
+def handle_addadmin(sender, profile_name, sender_is_admin, args):
+    """/addadmin [number] - become the first admin, or add another admin"""
+    number = args.strip()
     
-    # Load data
-    data = load_data()
+    if not sender_is_admin and store.bootstrap_admin(sender):
+        # First user becomes admin
+        return "👑 You are now an admin!"
     
-    # Initialize response
-    response = MessagingResponse()
-    reply = response.message()
+    if not sender_is_admin:
+        return "❌ Only existing admins can add new admins"
     
-    # Normalize command
-    msg = msg_body.lower()
+    if not number:
+        return ("✅ You're already an admin!\n\nAdmin commands:\n"
+                "/start - Start selection\n"
+                "/end - Create random teams\n"
+                "/makeadmin - Reply to message to add admin\n"
+                "/status - View current status\n"
+                "/reset - Reset session")
     
-    # === ADMIN COMMANDS ===
+    if number.lower().startswith(WHATSAPP_PREFIX):
+        number = number[len(WHATSAPP_PREFIX):]
+    elif not number.startswith("+"):
+        # Reply to a message to add that person as admin
+        return ("💡 To add someone as admin:\n\n"
+                "1. Ask them to send any message\n"
+                "2. Reply to their message with:\n"
+                "   /makeadmin\n\n"
+                "Current admins: " + str(len(store.get_admins())))
     
-    if msg.startswith("/addadmin"):
-        if not is_admin(sender, data) and len(data["admins"]) == 0:
-            # First user becomes admin
-            data["admins"].append(sender)
-            save_data(data)
-            reply.body("👑 You are now an admin!")
-        elif is_admin(sender, data):
-            # Check if trying to add someone else
-            parts = msg_body.split()
-            if len(parts) > 1:
-                # Reply to a message to add that person as admin
-                reply.body("💡 To add someone as admin:\n\n"
-                          "1. Ask them to send any message\n"
-                          "2. Reply to their message with:\n"
-                          "   /makeadmin\n\n"
-                          "Current admins: " + str(len(data["admins"])))
-            else:
-                reply.body("✅ You're already an admin!\n\nAdmin commands:\n"
-                          "/start - Start selection\n"
-                          "/end - Create random teams\n"
-                          "/makeadmin - Reply to message to add admin\n"
-                          "/status - View current status\n"
-                          "/reset - Reset session")
-        else:
-            reply.body("❌ Only existing admins can add new admins")
+    # Format properly, matching Twilio's "whatsapp:+<number>" senders
+    digits = NON_DIGITS_RE.sub("", number)
+    if not digits:
+        return "Usage: /addadmin +1234567890"
+    new_admin = f"{WHATSAPP_PREFIX}+{digits}"
     
-    elif msg == "/makeadmin":
-        if not is_admin(sender, data):
-            reply.body("❌ Only admins can add other admins")
-        else:
-            # Check if this is a reply to another message
-            quoted_msg_from = request.values.get("WaId", None)
-            
-            # For groups, we need to extract the person being replied to
-            # Unfortunately Twilio doesn't provide this easily in sandbox
-            # So we'll use a simpler approach with phone number
-            reply.body("💡 Due to sandbox limitations, please manually add admin:\n\n"
-                      "Send: /addadmin +1234567890\n"
-                      "(Replace with their WhatsApp number)")
+    if store.add_admin(new_admin):
+        return f"✅ Added {new_admin} as admin!\n\nTotal admins: {len(store.get_admins())}"
+    return "ℹ️ This person is already an admin"
+
+def handle_makeadmin(sender, profile_name, sender_is_admin, args):
+    if not sender_is_admin:
+        return "❌ Only admins can add other admins"
     
-    elif msg.startswith("/addadmin +") or msg.startswith("/addadmin whatsapp:"):
-        if not is_admin(sender, data):
-            reply.body("❌ Only admins can add other admins")
-        else:
-            try:
-                # Extract phone number from message
-                parts = msg_body.split()
-                if len(parts) >= 2:
-                    new_admin = parts[1]
-                    # Format properly
-                    if not new_admin.startswith("whatsapp:"):
-                        new_admin = f"whatsapp:{new_admin.replace('+', '').replace(' ', '')}"
-                    
-                    if new_admin not in data["admins"]:
-                        data["admins"].append(new_admin)
-                        save_data(data)
-                        reply.body(f"✅ Added {new_admin} as admin!\n\nTotal admins: {len(data['admins'])}")
-                    else:
-                        reply.body("ℹ️ This person is already an admin")
-                else:
-                    reply.body("Usage: /addadmin +1234567890")
-            except Exception as e:
-                reply.body(f"❌ Error adding admin. Usage: /addadmin +1234567890")
+    # For groups, we need to extract the person being replied to
+    # Unfortunately Twilio doesn't provide this easily in sandbox
+    # So we'll use a simpler approach with phone number
+    return ("💡 Due to sandbox limitations, please manually add admin:\n\n"
+            "Send: /addadmin +1234567890\n"
+            "(Replace with their WhatsApp number)")
+
+def handle_start(sender, profile_name, sender_is_admin, args):
+    if not sender_is_admin:
+        return "❌ Only admins can start selection"
     
-    elif msg == "/start":
-        if not is_admin(sender, data):
-            reply.body("❌ Only admins can start selection")
-        else:
-            data["session"]["active"] = True
-            data["session"]["participants"] = []
-            save_data(data)
-            reply.body("🎮 *TEAM SELECTION STARTED!*\n\n"
-                      "Reply with:\n"
-                      "• *in* - Join this week\n"
-                      "• *out* - Skip this week\n\n"
-                      "Admin will announce teams later!")
+    store.start_session()
+    return ("🎮 *TEAM SELECTION STARTED!*\n\n"
+            "Reply with:\n"
+            "• *in* - Join this week\n"
+            "• *out* - Skip this week\n\n"
+            "Admin will announce teams later!")
+
+def handle_end(sender, profile_name, sender_is_admin, args):
+    if not sender_is_admin:
+        return "❌ Only admins can end selection"
     
-    elif msg == "/end":
-        if not is_admin(sender, data):
-            reply.body("❌ Only admins can end selection")
-        elif not data["session"]["active"]:
-            reply.body("❌ No active session. Use /start first")
-        else:
-            # Get participating players
-            participants = data["session"]["participants"]
-            if not participants:
-                reply.body("❌ No players have joined yet!")
-            else:
-                # Build player list with names
-                player_list = []
-                for phone in participants:
-                    player_info = data["players"].get(phone, {
-                        "name": "Unknown"
-                    })
-                    player_list.append(player_info)
-                
-                # Create teams
-                teams = create_teams(player_list)
-                
-                # Format and send
-                result = f"🎲 *RANDOM TEAM SELECTION*\n\n{format_teams(teams)}"
-                result += f"Total Players: {len(player_list)}\n"
-                result += f"Teams Created: {len(teams)}"
-                
-                reply.body(result)
-                
-                # End session
-                data["session"]["active"] = False
-                save_data(data)
+    # Close the session and get its players in one step, so a late "in"
+    # can't slip in after the teams are drawn
+    participants = store.close_session()
+    if participants is None:
+        return "❌ No active session. Use /start first"
+    if not participants:
+        return "❌ No players have joined yet!"
     
-    elif msg == "/status":
-        if not is_admin(sender, data):
-            reply.body("❌ Admin only command")
-        else:
-            session = data["session"]
-            status = "🟢 ACTIVE" if session["active"] else "🔴 INACTIVE"
-            participant_count = len(session["participants"])
-            
-            status_msg = f"📊 *SESSION STATUS*\n\n"
-            status_msg += f"Status: {status}\n"
-            status_msg += f"Players In: {participant_count}\n\n"
-            
-            if participant_count > 0:
-                status_msg += "Participants:\n"
-                for phone in session["participants"]:
-                    player = data["players"].get(phone, {"name": "Unknown"})
-                    status_msg += f"  • {player['name']}\n"
-            
-            reply.body(status_msg)
+    # Build player list with names
+    player_list = [player or {"name": "Unknown"}
+                   for player in store.get_players(participants)]
     
-    elif msg == "/reset":
-        if not is_admin(sender, data):
-            reply.body("❌ Only admins can reset")
-        else:
-            data["session"]["active"] = False
-            data["session"]["participants"] = []
-            save_data(data)
-            reply.body("🔄 Session reset. Use /start to begin new selection")
+    # Create teams
+    teams = create_teams(player_list)
     
-    # === PLAYER COMMANDS ===
+    # Format and send
+    result = (f"🎲 *RANDOM TEAM SELECTION*\n\n{format_teams(teams)}"
+              f"Total Players: {len(player_list)}\n"
+              f"Teams Created: {len(teams)}")
     
-    elif msg == "in":
-        if not data["session"]["active"]:
-            reply.body("❌ No active selection. Wait for admin to /start")
-        else:
-            # Add to players if new
-            if sender not in data["players"]:
-                data["players"][sender] = {
-                    "name": profile_name
-                }
-            
-            # Add to participants
-            if sender not in data["session"]["participants"]:
-                data["session"]["participants"].append(sender)
-                save_data(data)
-                reply.body(f"✅ {data['players'][sender]['name']} is IN!\n"
-                          f"Current count: {len(data['session']['participants'])} players")
-            else:
-                reply.body(f"ℹ️ You're already in, {data['players'][sender]['name']}!")
+    return result
+
+def handle_status(sender, profile_name, sender_is_admin, args):
+    if not sender_is_admin:
+        return "❌ Admin only command"
     
-    elif msg == "out":
-        if not data["session"]["active"]:
-            reply.body("❌ No active selection")
-        else:
-            if sender in data["session"]["participants"]:
-                data["session"]["participants"].remove(sender)
-                save_data(data)
-                player_name = data["players"].get(sender, {}).get("name", profile_name)
-                reply.body(f"❌ {player_name} is OUT\n"
-                          f"Current count: {len(data['session']['participants'])} players")
-            else:
-                reply.body("ℹ️ You weren't in the list")
+    participants = store.get_participants()
+    status = "🟢 ACTIVE" if store.is_active() else "🔴 INACTIVE"
+    participant_count = len(participants)
     
-    elif msg == "/help":
-        help_text = "⚽ *FOOTBALL BOT COMMANDS*\n\n"
-        help_text += "*Everyone:*\n"
-        help_text += "• in - Join this week\n"
-        help_text += "• out - Skip this week\n\n"
-        
-        if is_admin(sender, data):
-            help_text += "*Admin Only:*\n"
-            help_text += "• /start - Start selection\n"
-            help_text += "• /end - Create random teams\n"
-            help_text += "• /status - View status\n"
-            help_text += "• /reset - Reset session"
-        
-        reply.body(help_text)
+    parts = ["📊 *SESSION STATUS*\n\n",
+             f"Status: {status}\n",
+             f"Players In: {participant_count}\n\n"]
     
-    else:
+    if participant_count > 0:
+        parts.append("Participants:\n")
+        parts.extend(f"  • {(player or {'name': 'Unknown'})['name']}\n"
+                     for player in store.get_players(participants))
+    
+    return "".join(parts)
+
+def handle_reset(sender, profile_name, sender_is_admin, args):
+    if not sender_is_admin:
+        return "❌ Only admins can reset"
+    
+    store.reset_session()
+    return "🔄 Session reset. Use /start to begin new selection"
+
+# === PLAYER COMMANDS ===
+
+def handle_in(sender, profile_name, sender_is_admin, args):
+    # Add to players if new; done first so /end never sees a participant
+    # without a name
+    name = store.setdefault_player(sender, profile_name)["name"]
+    
+    # Add to participants, checking the session is open in the same step
+    joined = store.join_session(sender)
+    if joined is None:
+        return "❌ No active selection. Wait for admin to /start"
+    if joined:
+        return (f"✅ {name} is IN!\n"
+                f"Current count: {store.count_participants()} players")
+    return f"ℹ️ You're already in, {name}!"
+
+def handle_out(sender, profile_name, sender_is_admin, args):
+    if not store.is_active():
+        return "❌ No active selection"
+    
+    if not store.remove_participant(sender):
+        return "ℹ️ You weren't in the list"
+    
+    player_name = (store.get_player(sender) or {}).get("name", profile_name)
+    return (f"❌ {player_name} is OUT\n"
+            f"Current count: {store.count_participants()} players")
+
+def handle_help(sender, profile_name, sender_is_admin, args):
+    if sender_is_admin:
+        return HELP_USER + HELP_ADMIN
+    return HELP_USER
+
+# mutates=False commands only read state, so they skip the store lock
+# and answer from memory once refresh() has picked up outside edits
+Command = namedtuple("Command", ["handler", "mutates"])
+
+# Handlers are called as handler(sender, profile_name, sender_is_admin, args)
+
+# Exact-match commands: {normalized message: Command}, called with args=""
+COMMANDS = {
+    "/makeadmin": Command(handle_makeadmin, mutates=False),
+    "/start": Command(handle_start, mutates=True),
+    "/end": Command(handle_end, mutates=True),
+    "/status": Command(handle_status, mutates=False),
+    "/reset": Command(handle_reset, mutates=True),
+    "in": Command(handle_in, mutates=True),
+    "out": Command(handle_out, mutates=True),
+    "/help": Command(handle_help, mutates=False),
+}
+
+# Commands taking arguments: {name: Command}, matched as "/name [args]"
+PREFIX_COMMANDS = {
+    "addadmin": Command(handle_addadmin, mutates=True),
+}
+CMD_RE = re.compile(r"^/(%s)(?:\s+(.*))?$" % "|".join(map(re.escape, PREFIX_COMMANDS)),
+                    re.IGNORECASE | re.DOTALL)
+
+# A plain def runs in FastAPI's threadpool, so the store lock and Redis
+# calls never block the event loop serving other webhooks
+@app.post("/whatsapp")
+def whatsapp_bot(
+    msg_body: str = Form("", alias="Body"),
+    sender: str = Form("", alias="From"),
+    profile_name: str = Form("Player", alias="ProfileName"),
+):
+    """Main webhook handler"""
+    msg_body = msg_body.strip()
+    
+    # Normalize command
+    msg = msg_body.lower()
+    command = COMMANDS.get(msg)
+    args = ""
+    if command is None:
+        match = CMD_RE.match(msg_body)
+        if match:
+            command = PREFIX_COMMANDS[match.group(1).lower()]
+            args = match.group(2) or ""
+    
+    if command is None:
         # Unknown command
-        if msg.startswith("/"):
-            reply.body("❓ Unknown command. Send /help for commands")
+        text = "❓ Unknown command. Send /help for commands" if msg.startswith("/") else None
+    else:
+        # Checked once per request; only slash commands care about it
+        is_slash_command = msg.startswith("/")
+        
+        # Admin status is checked after refresh(), so an admin removed
+        # from players.json loses their rights on their next request
+        if not command.mutates:
+            store.refresh()
+            sender_is_admin = is_slash_command and store.is_admin(sender)
+            text = command.handler(sender, profile_name, sender_is_admin, args)
+        else:
+            with store.lock:
+                store.refresh()
+                sender_is_admin = is_slash_command and store.is_admin(sender)
+                text = command.handler(sender, profile_name, sender_is_admin, args)
     
-    return str(response)
+    twiml = TWIML_TEMPLATE.format(body=xml_escape(text)) if text else TWIML_EMPTY
+    return Response(content=twiml, media_type="application/xml")
 
 if __name__ == "__main__":
+    import uvicorn
+    
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,13 @@
+"""Gunicorn settings for the football bot"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# The app is ASGI (FastAPI), served by uvicorn inside gunicorn workers
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# The JSON store keeps state in each worker's memory; only run several
+# workers when state is shared through Redis
+default_workers = multiprocessing.cpu_count() if os.environ.get("REDIS_URL") else 1
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
@@ -0,0 +1,452 @@
+"""Storage backends for admins, players and the weekly session"""
+import atexit
+import contextlib
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import orjson
+
+# Configuration
+DATA_FILE = "players.json"
+FLUSH_INTERVAL = 5  # Seconds between background writes of changed data
+
+# Initialize data structure
+def init_data():
+    """Initialize default data structure"""
+    return {
+        "admins": [],  # List of admin phone numbers
+        "players": {},  # {phone: {name}}
+        "session": {
+            "active": False,
+            "participants": []  # List of phones who said "in"
+        }
+    }
+
+# Last parse of DATA_FILE, reused while its mtime and size are unchanged
+_cache = {"mtime": 0, "size": 0, "data": None, "lock": threading.Lock()}
+
+def _cache_hit(st):
+    """Check whether a stat result matches the cached parse"""
+    return (_cache["data"] is not None
+            and (st.st_mtime_ns, st.st_size) == (_cache["mtime"], _cache["size"]))
+
+def _remember(st, data):
+    """Record data as the parsed contents of the file described by st"""
+    _cache["mtime"] = st.st_mtime_ns
+    _cache["size"] = st.st_size
+    _cache["data"] = data
+
+def read_data():
+    """
+    Return the parsed DATA_FILE, or None if it doesn't exist
+    Concurrent callers share one parse, and the file is only parsed
+    again once its mtime or size changes
+    """
+    try:
+        st = os.stat(DATA_FILE)
+    except FileNotFoundError:
+        return None
+    if _cache_hit(st):
+        return _cache["data"]
+
+    with _cache["lock"]:
+        # Another thread may have parsed it while we waited
+        if _cache_hit(os.stat(DATA_FILE)):
+            return _cache["data"]
+        with open(DATA_FILE, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = orjson.loads(f.read())
+        _remember(st, data)
+        return data
+
+def load_data():
+    """Load data with error handling"""
+    try:
+        data = read_data()
+        return data if data is not None else init_data()
+    except Exception as e:
+        print(f"Error loading data: {e}")
+        return init_data()
+
+class SessionStore(ABC):
+    """
+    Interface the webhook uses to read and change bot state
+    Checks that must happen together with an update (first admin, joining
+    an open session, closing it) are single methods, atomic on every
+    backend. Backends also set `lock`, which the webhook holds around
+    mutating commands; it only has to cover in-process state
+    """
+
+    def refresh(self):
+        """Pick up changes made outside this process, if needed"""
+
+    @abstractmethod
+    def is_admin(self, phone):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_admins(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_admin(self, phone):
+        """Add an admin, returning False if they already were one"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def bootstrap_admin(self, phone):
+        """Make phone an admin only if there are none yet; return whether it did"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_active(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def start_session(self):
+        """Open a new selection with no participants"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def close_session(self):
+        """
+        Close the selection, keeping its participants, and return them
+        Returns None if no selection is open, and [] (leaving it open) if
+        nobody has joined
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def reset_session(self):
+        """Close the selection and clear its participants"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_participants(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_participants(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def join_session(self, phone):
+        """
+        Add a participant to the open selection
+        Returns None if no selection is open, False if they were already in
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_participant(self, phone):
+        """Remove a participant, returning False if they weren't in"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_player(self, phone):
+        """Return {name} for a player, or None if unknown"""
+        raise NotImplementedError
+
+    def get_players(self, phones):
+        """Return get_player() for each phone, in order"""
+        return [self.get_player(phone) for phone in phones]
+
+    @abstractmethod
+    def setdefault_player(self, phone, name):
+        """Return the player for phone, adding them with name if unknown"""
+        raise NotImplementedError
+
+
+class JsonSessionStore(SessionStore):
+    """
+    Keeps state in memory and writes it to DATA_FILE in the background
+    State lives in this process only, so run a single worker (gunicorn's
+    default) or every worker will keep and write its own copy
+    """
+
+    def __init__(self):
+        # Re-entrant so handlers can hold it across store calls
+        self.lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        # Loaded once at startup; requests read and mutate this dict directly
+        self._set_data(load_data())
+        self.dirty = False
+
+        threading.Thread(target=self._flush_loop, name="data-flush", daemon=True).start()
+        atexit.register(self.flush_now)
+
+    def _set_data(self, data):
+        """Use data as the current state and rebuild its lookup sets"""
+        # Participants are held as a dict used as an ordered set, giving
+        # O(1) add/remove while keeping join order; saved as a list
+        data["session"]["participants"] = dict.fromkeys(data["session"]["participants"])
+        self.data = data
+        # Set alongside the JSON list for O(1) admin checks
+        self.admin_set = frozenset(data["admins"])
+
+    def refresh(self):
+        """Reload DATA_FILE if another process replaced it and we have no unsaved changes"""
+        with self.lock:
+            if self.dirty:
+                return
+            try:
+                data = read_data()
+            except Exception as e:
+                print(f"Error loading data: {e}")
+                return
+            if data is not None and data is not self.data:
+                self._set_data(data)
+
+    def mark_dirty(self):
+        """Mark data as changed; the flush thread writes it to disk"""
+        with self.lock:
+            self.dirty = True
+
+    def flush_now(self):
+        """Write data to disk if it changed since the last flush"""
+        # One writer at a time, so the flush thread and the atexit hook
+        # can't interleave writes or swap in an older payload
+        with self._write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = self.data
+                try:
+                    session = data["session"]
+                    payload = orjson.dumps({
+                        **data,
+                        "session": {**session, "participants": list(session["participants"])},
+                    })
+                except Exception as e:
+                    print(f"Error saving data: {e}")
+                    return
+                self.dirty = False
+
+            # Write a per-process temp file and swap it in with os.replace, so
+            # readers (and other workers) only ever see a complete file
+            tmp_file = f"{DATA_FILE}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "wb") as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    st = os.fstat(f.fileno())
+                os.replace(tmp_file, DATA_FILE)
+                # Our own write shouldn't make refresh() parse the file again
+                with _cache["lock"]:
+                    _remember(st, data)
+            except Exception as e:
+                print(f"Error saving data: {e}")
+                self.mark_dirty()
+
+    def _flush_loop(self):
+        """Background loop flushing dirty data every FLUSH_INTERVAL seconds"""
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush_now()
+
+    def is_admin(self, phone):
+        return phone in self.admin_set
+
+    def get_admins(self):
+        return list(self.data["admins"])
+
+    def add_admin(self, phone):
+        with self.lock:
+            if phone in self.admin_set:
+                return False
+            self.data["admins"].append(phone)
+            self.admin_set = self.admin_set | {phone}
+            self.mark_dirty()
+            return True
+
+    def bootstrap_admin(self, phone):
+        with self.lock:
+            if self.data["admins"]:
+                return False
+            return self.add_admin(phone)
+
+    def is_active(self):
+        return self.data["session"]["active"]
+
+    def start_session(self):
+        with self.lock:
+            self.data["session"]["active"] = True
+            self.data["session"]["participants"] = {}
+            self.mark_dirty()
+
+    def close_session(self):
+        with self.lock:
+            session = self.data["session"]
+            if not session["active"]:
+                return None
+            participants = list(session["participants"])
+            if participants:
+                session["active"] = False
+                self.mark_dirty()
+            return participants
+
+    def reset_session(self):
+        with self.lock:
+            self.data["session"]["active"] = False
+            self.data["session"]["participants"] = {}
+            self.mark_dirty()
+
+    def get_participants(self):
+        return list(self.data["session"]["participants"])
+
+    def count_participants(self):
+        return len(self.data["session"]["participants"])
+
+    def join_session(self, phone):
+        with self.lock:
+            session = self.data["session"]
+            if not session["active"]:
+                return None
+            participants = session["participants"]
+            if phone in participants:
+                return False
+            participants[phone] = None
+            self.mark_dirty()
+            return True
+
+    def remove_participant(self, phone):
+        with self.lock:
+            participants = self.data["session"]["participants"]
+            if phone not in participants:
+                return False
+            del participants[phone]
+            self.mark_dirty()
+            return True
+
+    def get_player(self, phone):
+        return self.data["players"].get(phone)
+
+    def setdefault_player(self, phone, name):
+        players = self.data["players"]
+        player = players.get(phone)
+        if player is None:
+            with self.lock:
+                player = players.setdefault(phone, {"name": name})
+                self.mark_dirty()
+        return player
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Keeps state in Redis so any number of workers can share it
+    Keys:
+      admins                -> Set of admin phones
+      players:{phone}       -> Hash {name}
+      session:active        -> "1" or "0"
+      session:participants  -> Sorted Set of phones who said "in", scored
+                               by join time so /status keeps join order
+    """
+
+    # Check-then-update steps run as Lua scripts, which Redis executes
+    # atomically, so workers never need to take a shared lock
+    BOOTSTRAP_ADMIN = """
+    if redis.call("SCARD", KEYS[1]) == 0 then
+        return redis.call("SADD", KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+    JOIN_SESSION = """
+    if redis.call("GET", KEYS[1]) ~= "1" then
+        return -1
+    end
+    return redis.call("ZADD", KEYS[2], "NX", ARGV[1], ARGV[2])
+    """
+    CLOSE_SESSION = """
+    if redis.call("GET", KEYS[1]) ~= "1" then
+        return false
+    end
+    local participants = redis.call("ZRANGE", KEYS[2], 0, -1)
+    if #participants > 0 then
+        redis.call("SET", KEYS[1], "0")
+    end
+    return participants
+    """
+
+    def __init__(self, client):
+        self.redis = client
+        # Every operation below is a single atomic command or script
+        self.lock = contextlib.nullcontext()
+        self._bootstrap_admin = client.register_script(self.BOOTSTRAP_ADMIN)
+        self._join_session = client.register_script(self.JOIN_SESSION)
+        self._close_session = client.register_script(self.CLOSE_SESSION)
+
+    def is_admin(self, phone):
+        return bool(self.redis.sismember("admins", phone))
+
+    def get_admins(self):
+        return list(self.redis.smembers("admins"))
+
+    def add_admin(self, phone):
+        return self.redis.sadd("admins", phone) == 1
+
+    def bootstrap_admin(self, phone):
+        return self._bootstrap_admin(keys=["admins"], args=[phone]) == 1
+
+    def is_active(self):
+        return self.redis.get("session:active") == "1"
+
+    def start_session(self):
+        pipe = self.redis.pipeline()
+        pipe.set("session:active", "1")
+        pipe.delete("session:participants")
+        pipe.execute()
+
+    def close_session(self):
+        return self._close_session(keys=["session:active", "session:participants"])
+
+    def reset_session(self):
+        pipe = self.redis.pipeline()
+        pipe.set("session:active", "0")
+        pipe.delete("session:participants")
+        pipe.execute()
+
+    def get_participants(self):
+        return self.redis.zrange("session:participants", 0, -1)
+
+    def count_participants(self):
+        return self.redis.zcard("session:participants")
+
+    def join_session(self, phone):
+        added = self._join_session(keys=["session:active", "session:participants"],
+                                   args=[time.time(), phone])
+        return None if added == -1 else added == 1
+
+    def remove_participant(self, phone):
+        return self.redis.zrem("session:participants", phone) == 1
+
+    def get_player(self, phone):
+        return self.redis.hgetall(f"players:{phone}") or None
+
+    def get_players(self, phones):
+        pipe = self.redis.pipeline(transaction=False)
+        for phone in phones:
+            pipe.hgetall(f"players:{phone}")
+        return [player or None for player in pipe.execute()]
+
+    def setdefault_player(self, phone, name):
+        # One round trip; HSETNX leaves an existing name alone
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(f"players:{phone}", "name", name)
+        pipe.hgetall(f"players:{phone}")
+        return pipe.execute()[1]
+
+
+def create_store():
+    """
+    Use Redis when REDIS_URL is set, otherwise the local JSON file
+    The redis package is optional; install requirements-redis.txt to use it
+    """
+    redis_url = os.environ.get("REDIS_URL")
+    if redis_url:
+        # Imported here so JSON-only deployments don't need the package
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(redis_url, decode_responses=True))
+    return JsonSessionStore()